@@ -14,14 +14,15 @@
 
 from rapidAligner.ED.stream_dists_fft import fft_sdist, fft_mdist, fft_zdist
 from rapidAligner.ED.stream_dists_kernels import sdist_kernel, mdist_kernel, zdist_kernel
-from rapidAligner.ED.stream_dists_helpers import mnorm, znorm
+from rapidAligner.ED.stream_dists_kernels import REAL_TYPES
+from rapidAligner.ED.stream_dists_helpers import mnorm, znorm, choose_mode
+from rapidAligner.ED.stream_dists_helpers import clear_cache
 
 import cupy as cp
-from numba import cuda
 
-__all__ = ["sdist", "mdist", "zdist"]
+__all__ = ["sdist", "mdist", "zdist", "clear_cache"]
 
-def sdist(Q, S, mode="fft"):
+def sdist(Q, S, mode="fft", dtype=None):
     """
     Rolling Euclidean Distance 
 
@@ -32,7 +33,10 @@ def sdist(Q, S, mode="fft"):
       S: cupy.core.core.ndarray or numba.cuda.DeviceNDArray or cudf.Series or numpy.ndarray
         the input stream of length n>=m to be scanned
       mode: str
-        either "naive" or "fft"
+        either "naive", "fft" or "auto" (crossover measured on first use)
+      dtype: numpy.dtype or str or None
+        cast query and stream to this dtype, e.g. "float32" to halve the
+        memory traffic of float64 input (None keeps the input dtype)
     Returns
     -------
     cupy.core.core.ndarray
@@ -40,26 +44,25 @@ def sdist(Q, S, mode="fft"):
 
     """
         
-    if not isinstance(Q, cp.core.core.ndarray):
-        Q = cp.asarray(Q)
-        
-    if not isinstance(S, cp.core.core.ndarray):
-        S = cp.asarray(S)
+    Q = cp.asarray(Q, dtype=dtype)
+    S = cp.asarray(S, dtype=dtype)
     
     assert(Q.dtype == S.dtype)
     assert((len(Q.shape) == len(S.shape) == 1 and Q.shape[0] <= S.shape[0])) 
 
+    if mode == "auto":
+        mode = choose_mode(len(Q), len(S), Q.dtype)
+    
     if mode == "fft":
         Z = fft_sdist(Q, S)
     else:
-        stream = cuda.stream()
+        assert(Q.dtype in REAL_TYPES), "naive mode requires float32 or float64 input"
         Z = cp.empty(len(S)-len(Q)+1, dtype=Q.dtype)
-        sdist_kernel[80*32, 64, stream](Q, S, Z)
-        stream.synchronize()
+        sdist_kernel(Q, S, Z)
     
     return Z
 
-def mdist(Q, S, mode="fft"):
+def mdist(Q, S, mode="fft", dtype=None):
     
     """
     Rolling mean-adjusted Euclidean Distance
@@ -71,7 +74,10 @@ def mdist(Q, S, mode="fft"):
       S: cupy.core.core.ndarray or numba.cuda.DeviceNDArray or cudf.Series or numpy.ndarray
         the input stream of length n>=m to be scanned
       mode: str
-        either "naive" or "fft"
+        either "naive", "fft" or "auto" (crossover measured on first use)
+      dtype: numpy.dtype or str or None
+        cast query and stream to this dtype, e.g. "float32" to halve the
+        memory traffic of float64 input (None keeps the input dtype)
     Returns
     -------
     cupy.core.core.ndarray
@@ -79,26 +85,25 @@ def mdist(Q, S, mode="fft"):
 
     """
     
-    if not isinstance(Q, cp.core.core.ndarray):
-        Q = cp.asarray(Q)
-        
-    if not isinstance(S, cp.core.core.ndarray):
-        S = cp.asarray(S)
+    Q = cp.asarray(Q, dtype=dtype)
+    S = cp.asarray(S, dtype=dtype)
     
     assert(Q.dtype == S.dtype)
     assert((len(Q.shape) == len(S.shape) == 1 and Q.shape[0] <= S.shape[0]))
     
+    if mode == "auto":
+        mode = choose_mode(len(Q), len(S), Q.dtype)
+    
     if mode == "fft":
         Z = fft_mdist(Q, S)
     else:
-        stream = cuda.stream()
+        assert(Q.dtype in REAL_TYPES), "naive mode requires float32 or float64 input"
         Z = cp.empty(len(S)-len(Q)+1, dtype=Q.dtype)
-        mdist_kernel[80*32, 64, stream](mnorm(Q), S, Z)
-        stream.synchronize()
+        mdist_kernel(mnorm(Q), S, Z)
     
     return Z
 
-def zdist(Q, S, mode="fft", epsilon=1e-6):
+def zdist(Q, S, mode="fft", epsilon=1e-6, dtype=None):
     """
     Rolling mean- and amplitude-adjusted Euclidean Distance 
 
@@ -111,7 +116,10 @@ def zdist(Q, S, mode="fft", epsilon=1e-6):
       epsilon: float
         non-negative number for regularizing zero stdev
       mode: str
-        either "naive" or "fft"
+        either "naive", "fft" or "auto" (crossover measured on first use)
+      dtype: numpy.dtype or str or None
+        cast query and stream to this dtype, e.g. "float32" to halve the
+        memory traffic of float64 input (None keeps the input dtype)
     Returns
     -------
     cupy.core.core.ndarray
@@ -119,23 +127,21 @@ def zdist(Q, S, mode="fft", epsilon=1e-6):
 
     """
     
-    if not isinstance(Q, cp.core.core.ndarray):
-        Q = cp.asarray(Q)
-        
-    if not isinstance(S, cp.core.core.ndarray):
-        S = cp.asarray(S)
+    Q = cp.asarray(Q, dtype=dtype)
+    S = cp.asarray(S, dtype=dtype)
     
     assert(epsilon > 0)
     assert(Q.dtype == S.dtype)
     assert((len(Q.shape) == len(S.shape) == 1 and Q.shape[0] <= S.shape[0]))
-    assert(cp.std(Q, ddof=0) > 0)
         
+    if mode == "auto":
+        mode = choose_mode(len(Q), len(S), Q.dtype)
+    
     if mode == "fft":
         Z = fft_zdist(Q, S, epsilon)
     else:
-        stream = cuda.stream()    
+        assert(Q.dtype in REAL_TYPES), "naive mode requires float32 or float64 input"
         Z = cp.empty(len(S)-len(Q)+1, dtype=Q.dtype)
-        zdist_kernel[80*32, 64, stream](znorm(Q, epsilon), S, Z, epsilon)
-        stream.synchronize()
+        zdist_kernel(znorm(Q, epsilon), S, Z, epsilon)
     
     return Z
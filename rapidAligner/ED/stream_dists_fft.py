@@ -12,11 +12,34 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from rapidAligner.ED.stream_dists_helpers import cumsum
+from rapidAligner.ED.stream_dists_helpers import rolling_sums, xcorr
 from rapidAligner.ED.stream_dists_helpers import mnorm, znorm
 import cupy as cp
 import math
 
+###############################################################################
+# fused epilogues to avoid materializing temporaries of length n
+###############################################################################
+
+@cp.fuse()
+def _sdist_epilogue(qsq, R, Y):
+    return qsq-2*R+Y
+
+@cp.fuse()
+def _mdist_epilogue(qsq, R, X, Y, m):
+    return qsq-2*R+(Y-X*X/m)
+
+_zdist_epilogue = cp.ElementwiseKernel(
+    'T R, T X, T Y, float64 m',
+    'T F',
+    '''
+    T mu    = X/m;
+    T var   = Y/m-mu*mu;
+    T scale = var > 0 ? rsqrt(var) : 0;
+    F = scale > 0 ? 2*(m-R*scale) : m;
+    ''',
+    'zdist_epilogue')
+
 def fft_sdist(Q, S, alignment=10000, Kahan=0):
     """
     Rolling Euclidean Distance using FFT to run in loglinear time
@@ -35,7 +58,9 @@ def fft_sdist(Q, S, alignment=10000, Kahan=0):
       S: cupy.core.core.ndarray
         the input stream of length n>=m to be scanned
       Kahan: int
-        non-negative number of Kahan summation adjustment rounds
+        non-negative number, any positive value enables compensated
+        summation in the rolling sums (ignored for m <= 256 where the
+        windows are summed directly)
     Returns
     -------
     cupy.core.core.ndarray
@@ -45,18 +70,19 @@ def fft_sdist(Q, S, alignment=10000, Kahan=0):
     
     assert(Q.dtype == S.dtype)
     
+    # cuFFT only transforms floating point data, integer input is promoted
+    dtype = cp.result_type(S.dtype, cp.float32)
+    Q, S = Q.astype(dtype, copy=False), S.astype(dtype, copy=False)
+    
     m = len(Q)
     n = (len(S)+alignment-1)//alignment*alignment
-    iS = cp.zeros(n, dtype=S.dtype)
-    iS[:len(S)] = S
-        
-    Y = cumsum(iS**2, Kahan)    
-    Y = Y[+m:]-Y[:-m]        
-    E = cp.zeros(n, dtype=Q.dtype)
-    E[:m] = Q
-    R = cp.fft.irfft(cp.fft.rfft(E).conj()*cp.fft.rfft(iS), n=n)
+
+    _, Y = rolling_sums(S, m, Kahan)
+    R = xcorr(Q, S, n)
+    k = len(S)-m+1
+    qsq = cp.dot(Q, Q) # stays on the device, broadcast by the epilogue
     
-    return (cp.sum(cp.square(Q))-2*R[:-m+1]+Y)[:len(S)-m+1]
+    return _sdist_epilogue(qsq, R[:k], Y[:k])
 
 def fft_mdist(Q, S, alignment=10000, Kahan=0):
     """
@@ -83,7 +109,9 @@ def fft_mdist(Q, S, alignment=10000, Kahan=0):
       S: cupy.core.core.ndarray
         the input stream of length n>=m to be scanned
       Kahan: int
-        non-negative number of Kahan summation adjustment rounds
+        non-negative number, any positive value enables compensated
+        summation in the rolling sums (ignored for m <= 256 where the
+        windows are summed directly)
     Returns
     -------
     cupy.core.core.ndarray
@@ -91,20 +119,21 @@ def fft_mdist(Q, S, alignment=10000, Kahan=0):
 
     """
     
+    assert(Q.dtype == S.dtype)
+    
+    # cuFFT only transforms floating point data, integer input is promoted
+    dtype = cp.result_type(S.dtype, cp.float32)
+    Q, S = Q.astype(dtype, copy=False), S.astype(dtype, copy=False)
+    
     m, Q = len(Q), mnorm(Q)
     n = (len(S)+alignment-1)//alignment*alignment
-    iS = cp.zeros(n).astype(S.dtype)
-    iS[:len(S)] = S
-    
-    X, Y = cumsum(iS, Kahan), cumsum(iS**2, Kahan)
-    X = X[+m:]-X[:-m]
-    Y = Y[+m:]-Y[:-m]
-    Z = Y-X*X/m
-    E = cp.zeros(n, dtype=Q.dtype)
-    E[:m] = Q
-    R = cp.fft.irfft(cp.fft.rfft(E).conj()*cp.fft.rfft(iS), n=n)
+
+    X, Y = rolling_sums(S, m, Kahan)
+    R = xcorr(Q, S, n)
+    k = len(S)-m+1
+    qsq = cp.dot(Q, Q) # stays on the device, broadcast by the epilogue
         
-    return (cp.sum(cp.square(Q))-2*R[:-m+1]+Z)[:len(S)-m+1]
+    return _mdist_epilogue(qsq, R[:k], X[:k], Y[:k], m)
 
 def fft_zdist(Q, S, epsilon, alignment=10000, Kahan=0):    
     """
@@ -133,7 +162,9 @@ def fft_zdist(Q, S, epsilon, alignment=10000, Kahan=0):
       epsilon: float
         non-negative number for regularizing zero stdev
       Kahan: int
-        non-negative number of Kahan summation adjustment rounds
+        non-negative number, any positive value enables compensated
+        summation in the rolling sums (ignored for m <= 256 where the
+        windows are summed directly)
     Returns
     -------
     cupy.core.core.ndarray
@@ -142,21 +173,18 @@ def fft_zdist(Q, S, epsilon, alignment=10000, Kahan=0):
     """
     
     assert(epsilon > 0)
-       
+    assert(Q.dtype == S.dtype)
+    
+    # cuFFT only transforms floating point data, integer input is promoted
+    dtype = cp.result_type(S.dtype, cp.float32)
+    Q, S = Q.astype(dtype, copy=False), S.astype(dtype, copy=False)
+    
     m, Q = len(Q), znorm(Q, epsilon)
     n = (len(S)+alignment-1)//alignment*alignment
-    iS = cp.zeros(n, dtype=S.dtype)
-    iS[:len(S)] = S
-    delta = n-len(S)
-    
-    X, Y = cumsum(iS, Kahan), cumsum(iS**2, Kahan)
-    X = X[+m:]-X[:-m]
-    Y = Y[+m:]-Y[:-m]
-    Z = cp.sqrt(cp.maximum(Y/m-cp.square(X/m), 0))
-    E = cp.zeros(n, dtype=Q.dtype)
-    E[:m] = Q
-    R = cp.fft.irfft(cp.fft.rfft(E).conj()*cp.fft.rfft(iS), n=n)
-    F = cp.where(Z > 0 , 2*(m-R[:-m+1]/Z), m*cp.ones_like(Z))
-    
-    return F[:len(S)-m+1]
+
+    X, Y = rolling_sums(S, m, Kahan)
+    R = xcorr(Q, S, n)
+    k = len(S)-m+1
+    
+    return _zdist_epilogue(R[:k], X[:k], Y[:k], m)
 
@@ -14,15 +14,52 @@
 # limitations under the License.
 
 import cupy as cp
+import cupyx.scipy.fftpack
+import math
+from rapidAligner.ED.stream_dists_kernels import wsums_kernel, scan_kernel, sdist_kernel, REAL_TYPES
+from collections import OrderedDict
+
+try:
+    from cupy.cuda import cub
+except ImportError:
+    cub = None
 
 ###############################################################################
 # helpers to avoid redundant code 
 ###############################################################################
 
-def cumsum(x, Kahan=0):
+def cumsum_neumaier(x, square=False):
+    """
+    Exclusive prefix sum using Neumaier's compensated summation. The
+    compensation terms are carried through all passes on the device,
+    i.e. no host synchronization is needed.
+    This function is not exposed to the user.
+
+    Arguments:
+    -------
+      x: cupy.core.core.ndarray
+        the floating point input array of length n to be scanned with operation +
+      square: bool
+        scan the squares of x instead of x (squared on load)
+    Returns
+    -------
+    cupy.core.core.ndarray
+        the computed exclusive prefix scan of length n+1
+
+    """
+
+    assert(x.dtype in REAL_TYPES)
+
+    y = cp.empty(len(x)+1, dtype=x.dtype)
+    y[0] = 0
+    scan_kernel(cp.ascontiguousarray(x), y, square)
+
+    return y
+
+def cumsum(x, Kahan=0, square=False):
     """
     Wrapper for exclusive prefix sum computation with an optional
-    refinement step using a approach similar to Kahan summation.
+    compensated (Neumaier) summation similar to Kahan summation.
     This function is not exposed to the user.
 
     Arguments:
@@ -30,7 +67,10 @@ def cumsum(x, Kahan=0):
       x: cupy.core.core.ndarray
         the input array of length n to be scanned with operation +
       Kahan: int
-        non-negative number of Kahan summation adjustment rounds
+        non-negative number, any positive value enables compensated
+        summation for floating point input
+      square: bool
+        scan the squares of x instead of x without a temporary array
     Returns
     -------
     cupy.core.core.ndarray
@@ -40,22 +80,230 @@ def cumsum(x, Kahan=0):
 
     assert(isinstance(Kahan, int) and Kahan >= 0)
 
+    if Kahan and x.dtype in REAL_TYPES:
+        return cumsum_neumaier(x, square)
+
     # allocate an empty array with leading 0
     y = cp.empty(len(x)+1, dtype=x.dtype)
     y[0] = 0
 
-    # compute the inclusive prefix sum starting at entry 1
-    cp.cumsum(x, out=y[1:])
+    # compute the inclusive prefix sum starting at entry 1 using CUB's
+    # in-place device scan if available, cp.cumsum otherwise
+    if square:
+        cp.multiply(x, x, out=y[1:])
+    else:
+        y[1:] = x
+    if cub is None or cub.cub_scan(y[1:], cub.CUPY_CUB_CUMSUM) is None:
+        cp.cumsum(x*x if square else x, out=y[1:])
     
-    # basically exploit that (d/dt int f(t) dt) - f(t) = r = 0 forall f(t)
-    # in case delta is non-vanishing due to numeric inaccuracies, we add
-    # the prefix scan of r to the final result (inaccuracies might add up)
-    if Kahan:
-        r = x-cp.diff(y)
-        if(cp.max(cp.abs(r))):
-            y += cumsum(r, Kahan-1)
     return y
 
+# the naive kernels take O(n*m) and the FFT-based path O(n*log n) time,
+# the naive mode is chosen for m < NAIVE_CROSSOVER*log2(n); the constant
+# factors depend on the GPU, thus None measures the constant once per
+# device and dtype on first use (set a number to skip the measurement)
+NAIVE_CROSSOVER = None
+CALIBRATION_LENGTH = 2**20
+
+_crossover_cache = {}
+
+def elapsed(func, *args):
+    """
+    Runtime of func(*args) on the current stream measured with CUDA events.
+    This function is not exposed to the user.
+
+    Arguments:
+    -------
+      func: callable
+        the function to be timed
+      args: tuple
+        the arguments passed to func
+    Returns
+    -------
+    float
+        the elapsed time in milliseconds
+
+    """
+
+    start, stop = cp.cuda.Event(), cp.cuda.Event()
+    start.record()
+    func(*args)
+    stop.record()
+    stop.synchronize()
+
+    return cp.cuda.get_elapsed_time(start, stop)
+
+def calibrate_crossover(dtype, n=CALIBRATION_LENGTH):
+    """
+    Measure the constant c of the crossover m < c*log2(n) between naive and
+    FFT mode by timing sdist in both modes on a random stream of length n
+    for the query lengths m = 8, 16, ..., 8192. The crossover is placed
+    in the geometric middle between the last m where the naive mode was
+    faster and the first m where it was not.
+    This function is not exposed to the user.
+
+    Arguments:
+    -------
+      dtype: numpy.dtype
+        the dtype of query and stream (float32 or float64)
+      n: int
+        the length of the benchmark stream
+    Returns
+    -------
+    float
+        the measured constant c
+
+    """
+
+    # imported here since stream_dists_fft depends on this module
+    from rapidAligner.ED.stream_dists_fft import fft_sdist
+
+    # a separate generator keeps the global random state of the user intact
+    S = cp.random.RandomState(42).standard_normal(n, dtype=dtype)
+    naive = lambda Q: sdist_kernel(Q, S, cp.empty(n-len(Q)+1, dtype=dtype))
+    fft = lambda Q: fft_sdist(Q, S)
+
+    # warm-up: kernel compilation, cuFFT plans and padding buffers
+    naive(S[:8].copy())
+    fft(S[:8].copy())
+
+    m = 8
+    while m < 8192:
+        Q = S[:m].copy()
+        if elapsed(naive, Q) >= elapsed(fft, Q):
+            break
+        m *= 2
+
+    return m/math.sqrt(2)/math.log2(n)
+
+def naive_crossover(dtype):
+    """
+    The constant c of the crossover m < c*log2(n) for the current device
+    and given dtype, NAIVE_CROSSOVER if set and measured once otherwise.
+    This function is not exposed to the user.
+
+    Arguments:
+    -------
+      dtype: numpy.dtype
+        the dtype of query and stream (float32 or float64)
+    Returns
+    -------
+    float
+        the constant c
+
+    """
+
+    if NAIVE_CROSSOVER is not None:
+        return NAIVE_CROSSOVER
+
+    key = (cp.cuda.Device().id, cp.dtype(dtype).char)
+    if key not in _crossover_cache:
+        _crossover_cache[key] = calibrate_crossover(cp.dtype(dtype))
+
+    return _crossover_cache[key]
+
+def choose_mode(m, n, dtype):
+    """
+    Select the faster compute mode for a query of length m and a stream
+    of length n based on the cost O(n*m) of the naive and O(n*log n) of
+    the FFT mode with a crossover measured on the current device. The
+    naive kernels are only available for float32 and float64 input.
+    This function is not exposed to the user.
+
+    Arguments:
+    -------
+      m: int
+        the length of the query
+      n: int
+        the length of the stream
+      dtype: numpy.dtype
+        the dtype of query and stream
+    Returns
+    -------
+    str
+        either "naive" or "fft"
+
+    """
+
+    if cp.dtype(dtype) not in REAL_TYPES:
+        return "fft"
+
+    return "naive" if m < naive_crossover(dtype)*math.log2(max(n, 2)) else "fft"
+
+def rolling_sums(x, m, Kahan=0, m_crit=256):
+    """
+    Rolling sum and rolling sum of squares over all windows of length m.
+    Short windows are summed directly in a single fused kernel, long
+    windows are obtained as differences of two prefix scans.
+    This function is not exposed to the user.
+
+    Arguments:
+    -------
+      x: cupy.core.core.ndarray
+        the input array of length n>=m to be scanned
+      m: int
+        the window length
+      Kahan: int
+        non-negative number, any positive value enables compensated
+        summation for floating point input (ignored for m <= m_crit)
+      m_crit: int
+        largest window length for which the fused kernel is used
+    Returns
+    -------
+    tuple of cupy.core.core.ndarray
+        the rolling sums X and sums of squares Y of length n-m+1
+
+    """
+
+    if m <= m_crit and x.dtype in REAL_TYPES:
+        X = cp.empty(len(x)-m+1, dtype=x.dtype)
+        Y = cp.empty(len(x)-m+1, dtype=x.dtype)
+        wsums_kernel(x, m, X, Y)
+        return X, Y
+
+    X, Y = cumsum(x, Kahan), cumsum(x, Kahan, square=True)
+
+    return X[+m:]-X[:-m], Y[+m:]-Y[:-m]
+
+# sum and sum of squares in a single pass, packed into the real and imaginary
+# part of one complex accumulator since ReductionKernel has a single output
+_moments_kernel = cp.ReductionKernel(
+    'T x',
+    'complex128 y',
+    'complex<double>(x, (double)x*x)',
+    'a+b',
+    'y = a',
+    'complex<double>(0, 0)',
+    'moments',
+    reduce_type='complex<double>')
+
+def moments(x):
+    """
+    Mean and (population) standard deviation of a given time series
+    computed in one sweep over x. The result stays on the device.
+    This function is not exposed to the user.
+
+    Arguments:
+    -------
+      x: cupy.core.core.ndarray
+        the input array of length n
+    Returns
+    -------
+    tuple of cupy.core.core.ndarray
+        the 0-dimensional mean and standard deviation in the dtype of x
+        for floating point input and in float64 otherwise
+
+    """
+
+    y = _moments_kernel(x)
+    mean = y.real/len(x)
+    sigma = cp.sqrt(cp.maximum(y.imag/len(x)-mean*mean, 0))
+
+    # integer input keeps a float result similar to cp.mean and cp.std
+    dtype = x.dtype if x.dtype.kind == 'f' else cp.float64
+
+    return mean.astype(dtype), sigma.astype(dtype)
+
 def mnorm(x):
     """
     Mean-adjustment of a given time series. Afterwards the time series
@@ -93,6 +341,191 @@ def znorm(x, epsilon):
     
     """    
     
-    return (x-cp.mean(x))/max(cp.std(x, ddof=0), epsilon)
+    mean, sigma = moments(x)
+    
+    # cp.maximum keeps the regularized stdev on the device (no host sync)
+    return (x-mean)/cp.maximum(sigma, epsilon)
+
+###############################################################################
+# cached cuFFT plans and buffers to avoid re-creation on repeated calls
+###############################################################################
+
+_plan_cache = OrderedDict()
+_plan_cache_size = 16
+
+_buffer_cache = OrderedDict()
+_buffer_cache_size = 2
+
+def lru_lookup(cache, size, key, factory):
+    """
+    Least-recently-used lookup of key in cache. On a miss the value is
+    created by calling factory() and the oldest entry is evicted in case
+    the cache holds more than size entries.
+    This function is not exposed to the user.
+
+    Arguments:
+    -------
+      cache: collections.OrderedDict
+        the cache to be queried
+      size: int
+        the maximum number of entries
+      key: hashable
+        the key to be looked up
+      factory: callable
+        creates the value on a miss
+    Returns
+    -------
+    object
+        the cached value
+
+    """
+
+    if key in cache:
+        cache.move_to_end(key)
+    else:
+        cache[key] = factory()
+        if len(cache) > size:
+            cache.popitem(last=False)
+
+    return cache[key]
+
+def get_plan(x, n, value_type):
+    """
+    Look up a cuFFT plan transforming the last axis of x to/from a real
+    signal of length n. Plans are kept in a small LRU cache keyed by
+    device, shape, dtype and transform type.
+    This function is not exposed to the user.
+
+    Arguments:
+    -------
+      x: cupy.core.core.ndarray
+        the input array to be transformed
+      n: int
+        the length of the real signal
+      value_type: str
+        either "R2C" or "C2R"
+    Returns
+    -------
+    cupy.cuda.cufft.Plan1d
+        the (possibly cached) plan
+
+    """
+
+    key = (cp.cuda.Device().id, x.shape, x.dtype.char, n, value_type)
+    factory = lambda: cupyx.scipy.fftpack.get_fft_plan(x, shape=(n,), axes=-1, value_type=value_type)
+
+    return lru_lookup(_plan_cache, _plan_cache_size, key, factory)
+
+def get_padding_buffer(shape, dtype):
+    """
+    Look up a zero-initialized device buffer of given shape and dtype that
+    is reused across calls on the same device and stream. Along with the
+    buffer a list of the written prefix length per row is returned: all
+    entries of a row beyond its prefix are guaranteed to be zero. The
+    caller has to keep the list up to date when writing to the buffer.
+    This function is not exposed to the user.
+
+    Arguments:
+    -------
+      shape: tuple
+        the shape (rows, n) of the buffer
+      dtype: numpy.dtype
+        the dtype of the buffer
+    Returns
+    -------
+    tuple of cupy.core.core.ndarray and list
+        the (possibly cached) buffer and its written prefix lengths
+
+    """
+
+    key = (cp.cuda.Device().id, cp.cuda.get_current_stream().ptr, shape, cp.dtype(dtype).char)
+    factory = lambda: (cp.zeros(shape, dtype=dtype), [0]*shape[0])
+
+    return lru_lookup(_buffer_cache, _buffer_cache_size, key, factory)
+
+def clear_cache():
+    """
+    Release all cached cuFFT plans (including their work areas) and all
+    cached padding buffers of the FFT compute mode. The memory is handed
+    back to CuPy's memory pool, use free_all_blocks() of the pool to also
+    return it to the device.
+
+    """
+
+    _plan_cache.clear()
+    _buffer_cache.clear()
+
+def rfft(x):
+    """
+    Real-to-complex FFT along the last axis using a cached plan.
+    This function is not exposed to the user.
+
+    Arguments:
+    -------
+      x: cupy.core.core.ndarray
+        the real input array with last axis of length n
+    Returns
+    -------
+    cupy.core.core.ndarray
+        the complex spectrum with last axis of length n//2+1
+
+    """
+
+    n = x.shape[-1]
+    with get_plan(x, n, 'R2C'):
+        return cp.fft.rfft(x, n=n)
+
+def irfft(x, n):
+    """
+    Complex-to-real inverse FFT along the last axis using a cached plan.
+    This function is not exposed to the user.
+
+    Arguments:
+    -------
+      x: cupy.core.core.ndarray
+        the complex spectrum with last axis of length n//2+1
+      n: int
+        the length of the real output
+    Returns
+    -------
+    cupy.core.core.ndarray
+        the real signal with last axis of length n
+
+    """
+
+    with get_plan(x, n, 'C2R'):
+        return cp.fft.irfft(x, n=n)
+
+def xcorr(Q, S, n):
+    """
+    Cross-correlation R[k] = sum_i Q[i]*S[i+k] via the Fourier theorem.
+    Both signals are zero-padded to length n and transformed with one
+    batched real-to-complex FFT.
+    This function is not exposed to the user.
+
+    Arguments:
+    -------
+      Q: cupy.core.core.ndarray
+        the input query of length m
+      S: cupy.core.core.ndarray
+        the input stream of length n>=m
+      n: int
+        the padded length of the transforms
+    Returns
+    -------
+    cupy.core.core.ndarray
+        the computed (circular) cross-correlation of length n
+
+    """
+
+    # the reused buffer is zero beyond the previously written prefixes,
+    # i.e. only the entries between the new and old lengths need a reset
+    buf, written = get_padding_buffer((2, n), S.dtype)
+    for row, x in enumerate((Q, S)):
+        buf[row, :len(x)] = x
+        if written[row] > len(x):
+            buf[row, len(x):written[row]].fill(0)
+        written[row] = len(x)
+    F = rfft(buf)
 
-        
\ No newline at end of file
+    return irfft(F[0].conj()*F[1], n)
@@ -12,115 +12,488 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from numba import cuda, float64
-from math import sqrt
+import cupy as cp
+import numpy as np
+
+# maximum number of bytes of the query staged in shared memory (48 KiB),
+# longer queries are streamed from global memory beyond this length
+QUERY_CACHE_BYTES = 48*1024
+
+# all kernels are instantiated for these types, accumulation is carried
+# out in the type of the input (use float64 input for full precision)
+REAL_TYPES = {np.dtype(np.float32): 'float', np.dtype(np.float64): 'double'}
+
+# launch configuration: one warp per window, 8 warps per block
+GRID, BLOCK = (80*8,), (256,)
+
+_source = r'''
+// the stream is read with 128-bit loads: 4 floats or 2 doubles per lane
+template <typename T> struct vec;
+template <> struct vec<float>  { typedef float4  type; static const int width = 4; };
+template <> struct vec<double> { typedef double2 type; static const int width = 2; };
+
+// the shared query is padded by one entry per 128 bytes such that the
+// strided accesses of the lanes (one per vector component) hit distinct banks
+template <typename T>
+__device__ __forceinline__ long long padded(long long index) {
+    return index+index/(128/sizeof(T));
+}
+
+template <typename T>
+__device__ __forceinline__ void stage_query(T* sQ, const T* __restrict__ Q, int cached) {
+    for (int index = threadIdx.x; index < cached; index += blockDim.x)
+        sQ[padded<T>(index)] = Q[index];
+    __syncthreads();
+}
+
+template <typename T>
+__device__ __forceinline__ T query(const T* sQ, const T* __restrict__ Q, long long index, int cached) {
+    return index < cached ? sQ[padded<T>(index)] : __ldg(Q+index);
+}
+
+// calls f(index, S[offset+position+index]) for all 0 <= index < m where the
+// lanes of a warp load aligned vectors covering the window of length m, S has
+// to be 16-byte aligned and offset is the start of the stream therein; entries
+// outside the window are masked, the first and last vector may extend beyond
+// the stream but never beyond its (at least 256-byte granular) allocation
+template <typename T, typename F>
+__device__ __forceinline__ void for_window(const T* __restrict__ S, int offset, long long position,
+                                           long long m, int laneIdx, F f) {
+    typedef typename vec<T>::type V;
+    const int W = vec<T>::width;
+    const V* __restrict__ SV = reinterpret_cast<const V*>(S);
+
+    const long long first = (offset+position)/W;
+    const long long last  = (offset+position+m-1)/W;
+    const long long shift = offset+position-first*W;
+
+    for (long long vector = first+laneIdx; vector <= last; vector += 32) {
+        const V value = __ldg(SV+vector);
+        const T* entry = reinterpret_cast<const T*>(&value);
+        const long long lower = (vector-first)*W-shift;
+
+        #pragma unroll
+        for (int k = 0; k < W; k++)
+            if (lower+k >= 0 && lower+k < m)
+                f(lower+k, entry[k]);
+    }
+}
+
+// compensated (Neumaier) summation, shared by the distance and scan kernels
+template <typename T>
+__device__ __forceinline__ void neumaier(T& total, T& comp, T value) {
+    const T t = total+value;
+    comp += fabs(total) >= fabs(value) ? (total-t)+value : (value-t)+total;
+    total = t;
+}
+
+// warp reduction, the result is only valid in lane 0
+template <typename T>
+__device__ __forceinline__ T warp_sum(T accum) {
+    for (int delta = 16; delta > 0; delta /= 2)
+        accum += __shfl_down_sync(0xFFFFFFFF, accum, delta);
+    return accum;
+}
+
+// compensated warp reduction, the result is broadcast to all lanes
+template <typename T>
+__device__ __forceinline__ void warp_sum(T& total, T& comp) {
+    for (int delta = 16; delta > 0; delta /= 2) {
+        const T value = __shfl_down_sync(0xFFFFFFFF, total, delta);
+        comp += __shfl_down_sync(0xFFFFFFFF, comp, delta);
+        neumaier(total, comp, value);
+    }
+    total = __shfl_sync(0xFFFFFFFF, total, 0);
+    comp  = __shfl_sync(0xFFFFFFFF, comp, 0);
+}
+
+///////////////////////////////////////////////////////////////////////////////
+// rolling sum and sum of squares
+///////////////////////////////////////////////////////////////////////////////
+
+template <typename T>
+__global__ void wsums_kernel(const T* __restrict__ S, int offset, T* __restrict__ X, T* __restrict__ Y,
+                             long long m, long long n) {
+    const int warpDim = blockDim.x/32;
+    const int warpIdx = threadIdx.x/32;
+    const int laneIdx = threadIdx.x%32;
+
+    const long long lower  = (long long)blockIdx.x*warpDim+warpIdx;
+    const long long stride = (long long)gridDim.x*warpDim;
+
+    for (long long position = lower; position < n-m+1; position += stride) {
+        T accum1 = 0, accum2 = 0;
+        for_window(S, offset, position, m, laneIdx, [&](long long, T value) {
+            accum1 += value;
+            accum2 += value*value;
+        });
+
+        accum1 = warp_sum(accum1);
+        accum2 = warp_sum(accum2);
+
+        if (laneIdx == 0) {
+            X[position] = accum1;
+            Y[position] = accum2;
+        }
+    }
+}
+
+///////////////////////////////////////////////////////////////////////////////
+// plain rolling Euclidean distance
+///////////////////////////////////////////////////////////////////////////////
+
+template <typename T>
+__global__ void sdist_kernel(const T* __restrict__ Q, const T* __restrict__ S, int offset, T* __restrict__ out,
+                             long long m, long long n, int cached) {
+    extern __shared__ __align__(16) unsigned char cache[];
+    T* sQ = reinterpret_cast<T*>(cache);
+    stage_query(sQ, Q, cached);
+
+    const int warpDim = blockDim.x/32;
+    const int warpIdx = threadIdx.x/32;
+    const int laneIdx = threadIdx.x%32;
+
+    const long long lower  = (long long)blockIdx.x*warpDim+warpIdx;
+    const long long stride = (long long)gridDim.x*warpDim;
+
+    for (long long position = lower; position < n-m+1; position += stride) {
+        T accum = 0;
+        for_window(S, offset, position, m, laneIdx, [&](long long index, T entry) {
+            const T value = query(sQ, Q, index, cached)-entry;
+            accum += value*value;
+        });
+
+        accum = warp_sum(accum);
+
+        if (laneIdx == 0)
+            out[position] = accum;
+    }
+}
+
+///////////////////////////////////////////////////////////////////////////////
+// mean-adjusted rolling Euclidean distance
+///////////////////////////////////////////////////////////////////////////////
+
+template <typename T>
+__global__ void mdist_kernel(const T* __restrict__ Q, const T* __restrict__ S, int offset, T* __restrict__ out,
+                             long long m, long long n, int cached) {
+    extern __shared__ __align__(16) unsigned char cache[];
+    T* sQ = reinterpret_cast<T*>(cache);
+    stage_query(sQ, Q, cached);
+
+    const int warpDim = blockDim.x/32;
+    const int warpIdx = threadIdx.x/32;
+    const int laneIdx = threadIdx.x%32;
+
+    // contiguous range of windows per warp to slide the mean
+    const long long windows = n-m+1;
+    const long long warps   = (long long)gridDim.x*warpDim;
+    const long long chunk   = (windows+warps-1)/warps;
+    const long long lower   = ((long long)blockIdx.x*warpDim+warpIdx)*chunk;
+    const long long upper   = lower+chunk < windows ? lower+chunk : windows;
+
+    if (lower >= upper)
+        return;
+
+    T accum1 = 0, comp1 = 0;
+    for_window(S, offset, lower, m, laneIdx, [&](long long, T value) {
+        accum1 += value;
+    });
+    warp_sum(accum1, comp1);
+
+    for (long long position = lower; position < upper; position++) {
+
+        // slide the window by one entry: O(1) instead of O(m) loads
+        if (position > lower) {
+            neumaier(accum1, comp1, +__ldg(S+offset+position+m-1));
+            neumaier(accum1, comp1, -__ldg(S+offset+position-1));
+        }
+
+        const T mean = (accum1+comp1)/T(m);
+        T accum = 0;
+        for_window(S, offset, position, m, laneIdx, [&](long long index, T entry) {
+            const T value = query(sQ, Q, index, cached)-entry+mean;
+            accum += value*value;
+        });
+
+        accum = warp_sum(accum);
+
+        if (laneIdx == 0)
+            out[position] = accum;
+    }
+}
+
+///////////////////////////////////////////////////////////////////////////////
+// mean- and amplitude-adjusted rolling Euclidean distance
+///////////////////////////////////////////////////////////////////////////////
+
+template <typename T>
+__global__ void zdist_kernel(const T* __restrict__ Q, const T* __restrict__ S, int offset, T* __restrict__ out,
+                             long long m, long long n, int cached, T epsilon) {
+    extern __shared__ __align__(16) unsigned char cache[];
+    T* sQ = reinterpret_cast<T*>(cache);
+    stage_query(sQ, Q, cached);
+
+    const int warpDim = blockDim.x/32;
+    const int warpIdx = threadIdx.x/32;
+    const int laneIdx = threadIdx.x%32;
+
+    // contiguous range of windows per warp to slide mean and stdev
+    const long long windows = n-m+1;
+    const long long warps   = (long long)gridDim.x*warpDim;
+    const long long chunk   = (windows+warps-1)/warps;
+    const long long lower   = ((long long)blockIdx.x*warpDim+warpIdx)*chunk;
+    const long long upper   = lower+chunk < windows ? lower+chunk : windows;
+
+    if (lower >= upper)
+        return;
+
+    T accum1 = 0, comp1 = 0, accum2 = 0, comp2 = 0;
+    for_window(S, offset, lower, m, laneIdx, [&](long long, T value) {
+        accum1 += value;
+        accum2 += value*value;
+    });
+    warp_sum(accum1, comp1);
+    warp_sum(accum2, comp2);
+
+    for (long long position = lower; position < upper; position++) {
+
+        // slide the window by one entry: O(1) instead of O(m) loads
+        if (position > lower) {
+            const T enter = __ldg(S+offset+position+m-1);
+            const T leave = __ldg(S+offset+position-1);
+            neumaier(accum1, comp1, +enter);
+            neumaier(accum1, comp1, -leave);
+            neumaier(accum2, comp2, +enter*enter);
+            neumaier(accum2, comp2, -leave*leave);
+        }
+
+        const T mean  = (accum1+comp1)/T(m);
+        const T var   = (accum2+comp2)/T(m)-mean*mean;
+        const T sigma = var > 0 ? sqrt(var) : epsilon;
+        const T scale = T(1)/sigma; // one division per window, not per entry
+
+        T accum = 0;
+        for_window(S, offset, position, m, laneIdx, [&](long long index, T entry) {
+            const T value = query(sQ, Q, index, cached)-(entry-mean)*scale;
+            accum += value*value;
+        });
+
+        accum = warp_sum(accum);
+
+        if (laneIdx == 0)
+            out[position] = accum;
+    }
+}
+'''
+
+# compensated exclusive prefix scan in three passes (reduce, scan of the
+# tile totals, downsweep) carrying a Neumaier correction term per value
+SCAN_BLOCK = 256
+SCAN_ITEMS = 16
+
+_scan_source = r'''
+#define SCAN_BLOCK %d
+#define SCAN_ITEMS %d
+#define SCAN_TILE  (SCAN_BLOCK*SCAN_ITEMS)
+
+template <typename T>
+__device__ __forceinline__ void combine(T& sum, T& comp, T other_sum, T other_comp) {
+    neumaier(sum, comp, other_sum);
+    comp += other_comp;
+}
+
+// input value, optionally squared on load to avoid a temporary array
+template <typename T>
+__device__ __forceinline__ T load(const T* x, long long index, int square) {
+    const T value = x[index];
+    return square ? value*value : value;
+}
+
+// compensated sum of the SCAN_ITEMS consecutive values owned by this thread
+template <typename T>
+__device__ __forceinline__ void thread_sum(const T* x, long long lower, long long n, int square, T& sum, T& comp) {
+    sum = comp = 0;
+    for (int k = 0; k < SCAN_ITEMS; k++)
+        if (lower+k < n)
+            neumaier(sum, comp, load(x, lower+k, square));
+}
+
+// Hillis-Steele block scan of (sum, comp) pairs: replaces the pair of each
+// thread by its exclusive prefix and returns the block total
+template <typename T>
+__device__ __forceinline__ void block_scan(T& sum, T& comp, T& total_sum, T& total_comp) {
+    __shared__ T s_sum[SCAN_BLOCK], s_comp[SCAN_BLOCK];
+    const int tid = threadIdx.x;
+
+    s_sum[tid] = sum;
+    s_comp[tid] = comp;
+    __syncthreads();
+
+    for (int offset = 1; offset < SCAN_BLOCK; offset *= 2) {
+        T other_sum = 0, other_comp = 0;
+        if (tid >= offset) {
+            other_sum = s_sum[tid-offset];
+            other_comp = s_comp[tid-offset];
+        }
+        __syncthreads();
+        if (tid >= offset) {
+            combine(sum, comp, other_sum, other_comp);
+            s_sum[tid] = sum;
+            s_comp[tid] = comp;
+        }
+        __syncthreads();
+    }
+
+    sum = tid ? s_sum[tid-1] : 0;
+    comp = tid ? s_comp[tid-1] : 0;
+    total_sum = s_sum[SCAN_BLOCK-1];
+    total_comp = s_comp[SCAN_BLOCK-1];
+    __syncthreads();
+}
+
+template <typename T>
+__global__ void scan_reduce(const T* x, T* sums, T* comps, long long n, int square) {
+    T sum, comp, total_sum, total_comp;
+    thread_sum(x, (long long)blockIdx.x*SCAN_TILE+threadIdx.x*SCAN_ITEMS, n, square, sum, comp);
+    block_scan(sum, comp, total_sum, total_comp);
+
+    if (threadIdx.x == 0) {
+        sums[blockIdx.x] = total_sum;
+        comps[blockIdx.x] = total_comp;
+    }
+}
+
+// exclusive scan of the tile totals by a single block
+template <typename T>
+__global__ void scan_totals(T* sums, T* comps, long long tiles) {
+    T carry_sum = 0, carry_comp = 0;
+
+    for (long long lower = 0; lower < tiles; lower += SCAN_BLOCK) {
+        const long long index = lower+threadIdx.x;
+        T sum = index < tiles ? sums[index] : 0;
+        T comp = index < tiles ? comps[index] : 0;
+        T total_sum, total_comp;
+
+        block_scan(sum, comp, total_sum, total_comp);
+        combine(sum, comp, carry_sum, carry_comp);
+        if (index < tiles) {
+            sums[index] = sum;
+            comps[index] = comp;
+        }
+        combine(carry_sum, carry_comp, total_sum, total_comp);
+    }
+}
+
+// inclusive scan of each tile offset by its exclusive tile prefix,
+// written behind the leading zero of y
+template <typename T>
+__global__ void scan_downsweep(const T* x, T* y, const T* sums, const T* comps, long long n, int square) {
+    const long long lower = (long long)blockIdx.x*SCAN_TILE+threadIdx.x*SCAN_ITEMS;
+    T sum, comp, total_sum, total_comp;
+    thread_sum(x, lower, n, square, sum, comp);
+    block_scan(sum, comp, total_sum, total_comp);
+
+    T run_sum = sums[blockIdx.x], run_comp = comps[blockIdx.x];
+    combine(run_sum, run_comp, sum, comp);
+    for (int k = 0; k < SCAN_ITEMS; k++)
+        if (lower+k < n) {
+            neumaier(run_sum, run_comp, load(x, lower+k, square));
+            y[lower+k+1] = run_sum+run_comp;
+        }
+}
+''' % (SCAN_BLOCK, SCAN_ITEMS)
+
+_module = cp.RawModule(
+    code=_source+_scan_source,
+    options=('-std=c++11',),
+    name_expressions=['%s<%s>' % (kernel, ctype)
+                      for kernel in ['wsums_kernel', 'sdist_kernel', 'mdist_kernel', 'zdist_kernel',
+                                     'scan_reduce', 'scan_totals', 'scan_downsweep']
+                      for ctype in REAL_TYPES.values()])
 
 ###############################################################################
-# plain rolling Euclidean distance
+# launchers (all kernels run on CuPy's current stream)
 ###############################################################################
 
-@cuda.jit
-def sdist_kernel(Q, S, out):
-    """Euclidean Distance naive kernel: nothing cached"""
+def _function(name, dtype):
+    return _module.get_function('%s<%s>' % (name, REAL_TYPES[dtype]))
+
+def _aligned(x):
+    """contiguous x extended to the preceding 16-byte boundary and the offset
+    of x therein: the leading entries belong to the same allocation and are
+    masked by the kernels, i.e. unaligned views need no copy"""
     
-    warpDim = cuda.blockDim.x  // 32
-    warpIdx = cuda.threadIdx.x // 32
-    laneIdx = cuda.threadIdx.x  % 32
+    x = cp.ascontiguousarray(x)
+    assert(x.data.ptr % x.itemsize == 0)
+    offset = (x.data.ptr % 16)//x.itemsize
+    base = cp.ndarray((offset+len(x),), dtype=x.dtype, memptr=x.data-offset*x.itemsize)
     
-    lower  = cuda.blockIdx.x*warpDim+warpIdx
-    stride = cuda.gridDim.x*warpDim
+    return base, offset
+
+def _query_cache(Q):
+    """number of query entries cached in shared memory and the bytes needed"""
     
-    for position in range(lower, S.shape[0]-Q.shape[0]+1, stride):
+    entries = QUERY_CACHE_BYTES//Q.itemsize
+    pad = 128//Q.itemsize
+    cached = min(len(Q), entries-entries//pad-1)
     
-        accum = float64(0)
-        for index in range(laneIdx, Q.shape[0], 32):
-            value  = Q[index]-S[position+index]
-            accum += value*value
-        
-        for delta in [16, 8, 4, 2, 1]:
-            value  = cuda.shfl_down_sync(0xFFFFFFFF, accum, delta)
-            accum += value
+    return cached, Q.itemsize*(cached+cached//pad+1)
+
+def wsums_kernel(S, m, X, Y):
+    """rolling sum and sum of squares naive kernel: nothing cached"""
     
-        if laneIdx == 0:
-            out[position] = accum
-        
-###############################################################################
-# mean-adjusted rolling Euclidean distance
-###############################################################################
+    n = len(S)
+    S, offset = _aligned(S)
+    kernel = _function('wsums_kernel', S.dtype)
+    kernel(GRID, BLOCK, (S, cp.int32(offset), X, Y, cp.int64(m), cp.int64(n)))
 
-@cuda.jit(max_registers=63)
-def mdist_kernel(Q, S, out):
-    """mean-adjusted Euclidean Distance naive kernel: nothing cached"""
+def scan_kernel(x, y, square):
+    """compensated exclusive prefix scan naive kernels: x (or its squares) is
+    scanned into y[1:] in tiles of SCAN_BLOCK*SCAN_ITEMS entries, y[0] is kept"""
     
-    warpDim = cuda.blockDim.x  // 32
-    warpIdx = cuda.threadIdx.x // 32
-    laneIdx = cuda.threadIdx.x  % 32
+    n = len(x)
+    tiles = max((n+SCAN_BLOCK*SCAN_ITEMS-1)//(SCAN_BLOCK*SCAN_ITEMS), 1)
+    sums = cp.empty(tiles, dtype=x.dtype)
+    comps = cp.empty(tiles, dtype=x.dtype)
     
-    lower  = cuda.blockIdx.x*warpDim+warpIdx
-    stride = cuda.gridDim.x*warpDim
+    reduce = _function('scan_reduce', x.dtype)
+    totals = _function('scan_totals', x.dtype)
+    downsweep = _function('scan_downsweep', x.dtype)
     
-    for position in range(lower, S.shape[0]-Q.shape[0]+1, stride):
+    reduce((tiles,), (SCAN_BLOCK,), (x, sums, comps, cp.int64(n), cp.int32(square)))
+    totals((1,), (SCAN_BLOCK,), (sums, comps, cp.int64(tiles)))
+    downsweep((tiles,), (SCAN_BLOCK,), (x, y, sums, comps, cp.int64(n), cp.int32(square)))
+
+def sdist_kernel(Q, S, out):
+    """Euclidean Distance naive kernel: query cached in shared memory"""
     
-        accum = float64(0)
-        for index in range(laneIdx, Q.shape[0], 32):
-            accum += S[position+index]
-            
-        for delta in [16, 8, 4, 2, 1]:
-            accum += cuda.shfl_xor_sync(0xFFFFFFFF, accum, delta)
-        
-        mean = accum/Q.shape[0]
-        accum = float64(0)
-        for index in range(laneIdx, Q.shape[0], 32):
-            value  = Q[index]-S[position+index]+mean
-            accum += value*value
-        
-        for delta in [16, 8, 4, 2, 1]:
-            value  = cuda.shfl_down_sync(0xFFFFFFFF, accum, delta)
-            accum += value
+    n = len(S)
+    Q, (S, offset) = cp.ascontiguousarray(Q), _aligned(S)
+    cached, sbytes = _query_cache(Q)
+    kernel = _function('sdist_kernel', Q.dtype)
+    kernel(GRID, BLOCK, (Q, S, cp.int32(offset), out, cp.int64(len(Q)), cp.int64(n), cp.int32(cached)),
+           shared_mem=sbytes)
+
+def mdist_kernel(Q, S, out):
+    """mean-adjusted Euclidean Distance naive kernel: query cached in shared memory,
+    rolling mean updated along a contiguous range of windows per warp"""
     
-        if laneIdx == 0:
-            out[position] = accum
-            
-###############################################################################
-# mean- and amplitude-adjusted rolling Euclidean distance
-###############################################################################
+    n = len(S)
+    Q, (S, offset) = cp.ascontiguousarray(Q), _aligned(S)
+    cached, sbytes = _query_cache(Q)
+    kernel = _function('mdist_kernel', Q.dtype)
+    kernel(GRID, BLOCK, (Q, S, cp.int32(offset), out, cp.int64(len(Q)), cp.int64(n), cp.int32(cached)),
+           shared_mem=sbytes)
 
-@cuda.jit(max_registers=63)
 def zdist_kernel(Q, S, out, epsilon):
-    """z-normalized Euclidean Distance naive kernel: nothing cached"""
-    
-    warpDim = cuda.blockDim.x  // 32
-    warpIdx = cuda.threadIdx.x // 32
-    laneIdx = cuda.threadIdx.x  % 32
-    
-    lower  = cuda.blockIdx.x*warpDim+warpIdx
-    stride = cuda.gridDim.x*warpDim
-    
-    for position in range(lower, S.shape[0]-Q.shape[0]+1, stride):
+    """z-normalized Euclidean Distance naive kernel: query cached in shared memory,
+    rolling mean and stdev updated along a contiguous range of windows per warp"""
     
-        accum1 = float64(0)
-        accum2 = float64(0)
-        for index in range(laneIdx, Q.shape[0], 32):
-            value   = S[position+index]
-            accum1 += value
-            accum2 += value*value
-                
-        for delta in [16, 8, 4, 2, 1]:
-            accum1 += cuda.shfl_xor_sync(0xFFFFFFFF, accum1, delta)
-            accum2 += cuda.shfl_xor_sync(0xFFFFFFFF, accum2, delta)
-        
-        mean  = accum1/Q.shape[0]
-        sigma = accum2/Q.shape[0]-mean*mean
-        sigma = sqrt(sigma) if sigma > 0.0 else epsilon
-        
-        accum = float64(0)
-        for index in range(laneIdx, Q.shape[0], 32):
-            value  = Q[index]-(S[position+index]-mean)/sigma
-            accum += value*value
-        
-        for delta in [16, 8, 4, 2, 1]:
-            accum += cuda.shfl_down_sync(0xFFFFFFFF, accum, delta)
-            
-        if laneIdx == 0:
-            out[position] = accum
-        
\ No newline at end of file
+    n = len(S)
+    Q, (S, offset) = cp.ascontiguousarray(Q), _aligned(S)
+    cached, sbytes = _query_cache(Q)
+    kernel = _function('zdist_kernel', Q.dtype)
+    kernel(GRID, BLOCK, (Q, S, cp.int32(offset), out, cp.int64(len(Q)), cp.int64(n), cp.int32(cached),
+                         Q.dtype.type(epsilon)),
+           shared_mem=sbytes)
@@ -22,9 +22,10 @@ from scipy.io import loadmat
 
 class ECGLoader:
     
-    def __init__(self, root='./data/ECG', url=None):
+    def __init__(self, root='./data/ECG', url=None, dtype=None):
         
         self.root = root
+        self.dtype = dtype
         
         assert url != None, \
         "provide the URL to 22h of ECG data stated on the bottom of https://www.cs.ucr.edu/~eamonn/UCRsuite.html"
@@ -41,11 +42,13 @@ class ECGLoader:
     
     @property
     def subject(self, alpha=400.0, beta=50.0):
-        return alpha*loadmat(os.path.join(self.root, 'ECG_one_day','ECG.mat'))['ECG'].flatten()+beta
+        subject = alpha*loadmat(os.path.join(self.root, 'ECG_one_day','ECG.mat'))['ECG'].flatten()+beta
+        return subject if self.dtype is None else subject.astype(self.dtype)
     
     @property
     def query(self):
-        return loadmat(os.path.join(self.root, 'ECG_one_day','ECG_query.mat'))['ecg_query'].flatten()
+        query = loadmat(os.path.join(self.root, 'ECG_one_day','ECG_query.mat'))['ecg_query'].flatten()
+        return query if self.dtype is None else query.astype(self.dtype)
     
     @property
     def data(self):
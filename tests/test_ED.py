@@ -0,0 +1,202 @@
+# Copyright (c) 2020, NVIDIA CORPORATION.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+import pytest
+
+cp = pytest.importorskip("cupy")
+import rapidAligner as ra
+from rapidAligner.ED import stream_dists_helpers as helpers
+from rapidAligner.ED.stream_dists_fft import fft_sdist, fft_zdist
+from rapidAligner.ED.stream_dists_helpers import cumsum, choose_mode
+from rapidAligner.ED.stream_dists_kernels import SCAN_BLOCK, SCAN_ITEMS
+
+# stream length not divisible by the vector width of the naive kernels
+N = 4099
+
+# tolerance relative to the largest distance
+RTOL = {np.float32: 1e-3, np.float64: 1e-8}
+
+# tolerance of the compensated scan relative to the prefix sums
+SCAN_RTOL = {np.float32: 1e-6, np.float64: 1e-13}
+SCAN_TILE = SCAN_BLOCK*SCAN_ITEMS
+
+###############################################################################
+# NumPy references computed in float64
+###############################################################################
+
+def windows(S, m):
+    return np.lib.stride_tricks.sliding_window_view(S, m)
+
+def ref_sdist(Q, S):
+    return ((windows(S, len(Q))-Q)**2).sum(axis=1)
+
+def ref_mdist(Q, S):
+    W = windows(S, len(Q))
+    return ((W-W.mean(axis=1, keepdims=True)-(Q-Q.mean()))**2).sum(axis=1)
+
+def ref_zdist(Q, S, epsilon=1e-6):
+    W = windows(S, len(Q))
+    W = (W-W.mean(axis=1, keepdims=True))/np.maximum(W.std(axis=1, keepdims=True), epsilon)
+    return ((W-(Q-Q.mean())/max(Q.std(), epsilon))**2).sum(axis=1)
+
+DISTS = {"sdist": (ra.sdist, ref_sdist),
+         "mdist": (ra.mdist, ref_mdist),
+         "zdist": (ra.zdist, ref_zdist)}
+
+###############################################################################
+# helpers to avoid redundant code
+###############################################################################
+
+def make_data(m, offset, dtype, seed=42):
+    """query of length m and a stream view of length N+m starting at offset"""
+
+    rng = np.random.default_rng(seed)
+    Q = rng.standard_normal(m)+3.0
+    S = np.cumsum(rng.standard_normal(offset+N+m))/64+3.0
+
+    # the view at an odd offset is not aligned to the vector loads
+    dS = cp.asarray(S.astype(dtype))[offset:]
+
+    return Q, S[offset:], cp.asarray(Q.astype(dtype)), dS
+
+def assert_close(result, expected, dtype):
+    scale = max(np.abs(expected).max(), 1.0)
+    np.testing.assert_allclose(cp.asnumpy(result), expected, rtol=0, atol=RTOL[dtype]*scale)
+
+###############################################################################
+# naive and FFT mode against the NumPy reference
+###############################################################################
+
+@pytest.mark.parametrize("name", sorted(DISTS))
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+@pytest.mark.parametrize("offset", [0, 1, 3])
+@pytest.mark.parametrize("m", [5, 37, 300])
+@pytest.mark.parametrize("mode", ["naive", "fft"])
+def test_reference(name, dtype, offset, m, mode):
+    dist, ref = DISTS[name]
+    Q, S, dQ, dS = make_data(m, offset, dtype)
+
+    Z = dist(dQ, dS, mode=mode)
+
+    assert Z.dtype == dtype and len(Z) == len(S)-m+1
+    assert_close(Z, ref(Q, S), dtype)
+
+###############################################################################
+# automatic choice of the compute mode
+###############################################################################
+
+@pytest.mark.parametrize("dtype", [np.int32, np.int64, np.float16])
+def test_choose_mode_non_float(dtype):
+    assert choose_mode(4, 2**20, dtype) == "fft"
+
+@pytest.mark.parametrize("name", sorted(DISTS))
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+@pytest.mark.parametrize("m", [5, 300])
+def test_auto(name, dtype, m):
+    dist, ref = DISTS[name]
+    Q, S, dQ, dS = make_data(m, 1, dtype)
+
+    assert choose_mode(m, len(S), dtype) in ["naive", "fft"]
+    assert_close(dist(dQ, dS, mode="auto"), ref(Q, S), dtype)
+
+###############################################################################
+# naive against FFT mode for queries exceeding the shared memory cache
+###############################################################################
+
+@pytest.mark.parametrize("name", sorted(DISTS))
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+@pytest.mark.parametrize("offset", [0, 1])
+@pytest.mark.parametrize("m", [6001, 12001])
+def test_naive_fft(name, dtype, offset, m):
+    dist, _ = DISTS[name]
+    _, _, dQ, dS = make_data(m, offset, dtype)
+
+    expected = cp.asnumpy(dist(dQ, dS, mode="fft")).astype(np.float64)
+
+    assert_close(dist(dQ, dS, mode="naive"), expected, dtype)
+
+###############################################################################
+# compensated prefix scan used by the rolling sums for m > 256
+###############################################################################
+
+@pytest.mark.parametrize("square", [False, True])
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+@pytest.mark.parametrize("n", [0, 1, SCAN_TILE, SCAN_TILE+1, (SCAN_BLOCK+1)*SCAN_TILE+5])
+def test_compensated_scan(n, dtype, square):
+    x = np.random.default_rng(3).uniform(0, 1, n).astype(dtype)
+
+    y = cumsum(cp.asarray(x), Kahan=1, square=square)
+
+    x = x.astype(np.float64)
+    expected = np.concatenate([[0], np.cumsum(x*x if square else x)])
+
+    assert y.dtype == dtype
+    np.testing.assert_allclose(cp.asnumpy(y), expected, rtol=SCAN_RTOL[dtype], atol=0)
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_fft_zdist_kahan(dtype):
+    Q, S, dQ, dS = make_data(300, 1, dtype)
+
+    assert_close(fft_zdist(dQ, dS, 1e-6, Kahan=1), ref_zdist(Q, S), dtype)
+
+###############################################################################
+# reuse of the cached padding buffer and cache clearing
+###############################################################################
+
+def test_padding_buffer_reuse():
+    ra.clear_cache()
+    rng = np.random.default_rng(11)
+    Q, S = rng.standard_normal(2000), rng.standard_normal(9000)
+    dQ, dS = cp.asarray(Q), cp.asarray(S)
+
+    # both calls are padded to the same n and share one cached buffer
+    assert_close(fft_sdist(dQ, dS), ref_sdist(Q, S), np.float64)
+    assert len(helpers._buffer_cache) == 1
+    assert_close(fft_sdist(dQ[:500], dS[:8000]), ref_sdist(Q[:500], S[:8000]), np.float64)
+    assert len(helpers._buffer_cache) == 1
+
+    # the entries beyond the shorter prefixes have been reset to zero
+    buf, written = next(iter(helpers._buffer_cache.values()))
+    assert written == [500, 8000]
+    assert not buf[0, 500:].any() and not buf[1, 8000:].any()
+
+    ra.clear_cache()
+    assert not helpers._buffer_cache and not helpers._plan_cache
+
+    assert_close(fft_sdist(dQ, dS), ref_sdist(Q, S), np.float64)
+    assert len(helpers._buffer_cache) == 1 and len(helpers._plan_cache) == 2
+
+###############################################################################
+# integer and host input
+###############################################################################
+
+@pytest.mark.parametrize("name", sorted(DISTS))
+def test_integer_input(name):
+    dist, ref = DISTS[name]
+    rng = np.random.default_rng(7)
+    Q = rng.integers(-100, 100, 64).astype(np.int32)
+    S = rng.integers(-100, 100, N).astype(np.int32)
+
+    assert_close(dist(Q, S, mode="fft"), ref(Q.astype(np.float64), S.astype(np.float64)), np.float64)
+
+@pytest.mark.parametrize("name", sorted(DISTS))
+def test_dtype_cast(name):
+    dist, ref = DISTS[name]
+    Q, S, _, _ = make_data(300, 0, np.float64)
+
+    Z = dist(Q, S, dtype="float32")
+
+    assert Z.dtype == np.float32
+    assert_close(Z, ref(Q, S), np.float32)